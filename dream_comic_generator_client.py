@@ -1,258 +1,157 @@
 import requests
-import io
-from PIL import Image
-import os
 import streamlit as st
-import json
-import datetime
-from pathlib import Path
-import shutil
-
-# Variables
-url = "https://api.jimmyn.idv.tw"
+import orjson
+from dream_comic_ui import (
+    url,
+    SESSION,
+    run_in_background,
+    PANELS_DIR,
+    FIXED_HEIGHT_CSS,
+    save_generation_metadata,
+    delete_session,
+    delete_all_history,
+    get_previous_generations,
+    fetch_panel_images,
+    display_comic_from_metadata,
+    render_panels,
+)
 
 # Initialize session state to track view mode
 if 'view_mode' not in st.session_state:
     st.session_state.view_mode = 'new'
 if 'selected_session' not in st.session_state:
     st.session_state.selected_session = None
-if 'refresh_history' not in st.session_state:
-    st.session_state.refresh_history = False
+if 'confirm_delete_all' not in st.session_state:
+    st.session_state.confirm_delete_all = False
+if 'gen_future' not in st.session_state:
+    st.session_state.gen_future = None
+    st.session_state.gen_prompt = None
+    st.session_state.gen_result = None
+    st.session_state.gen_error = None
 
 # Set wide mode as default
 st.set_page_config(layout="wide")
 
 # Add custom CSS for fixed-height description containers
-st.markdown("""
-<style>
-    .fixed-height-container {
-        height: 150px;
-        overflow-y: auto;
-        margin-bottom: 10px;
-        background-color: rgba(240, 240, 240, 0.3);
-        padding: 8px;
-        border-radius: 4px;
-    }
-</style>
-""", unsafe_allow_html=True)
-
-# Function to create fixed-height description container
-def fixed_height_container(text):
-    st.markdown(f'<div class="fixed-height-container">{text}</div>', unsafe_allow_html=True)
-
-# Function to save generation metadata
-def save_generation_metadata(session_id, prompt, response_data):
-    save_dir = Path(__file__).parent / "dream_comics" / session_id
-    save_dir.mkdir(parents=True, exist_ok=True)
-    
-    # Create metadata with timestamp and prompt
-    metadata = {
-        'session_id': session_id,
-        'timestamp': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        'prompt': prompt,
-        'response_data': response_data
-    }
-    
-    # Save metadata to JSON file
-    with open(save_dir / "metadata.json", 'w') as f:
-        json.dump(metadata, f, indent=4)
-
-# Function to delete a specific session
-def delete_session(session_id):
-    try:
-        session_dir = Path(__file__).parent / "dream_comics" / session_id
-        if session_dir.exists():
-            shutil.rmtree(session_dir)
-            st.session_state.refresh_history = True
-            # Reset selected session if it was deleted
-            if (st.session_state.selected_session and 
-                st.session_state.selected_session.get('session_id') == session_id):
-                st.session_state.selected_session = None
-                st.session_state.view_mode = 'new'
-            return True
-        return False
-    except Exception as e:
-        st.error(f"Error deleting session: {e}")
-        return False
-
-# Function to delete all history
-def delete_all_history():
-    try:
-        dream_comics_dir = Path(__file__).parent / "dream_comics"
-        if dream_comics_dir.exists():
-            for item in dream_comics_dir.iterdir():
-                if item.is_dir():
-                    shutil.rmtree(item)
-            st.session_state.refresh_history = True
-            st.session_state.selected_session = None
-            st.session_state.view_mode = 'new'
-            return True
-        return False
-    except Exception as e:
-        st.error(f"Error deleting all history: {e}")
-        return False
-
-# Function to get list of previous generations
-def get_previous_generations():
-    dream_comics_dir = Path(__file__).parent / "dream_comics"
-    if not dream_comics_dir.exists():
-        return []
-    
-    generations = []
-    for session_dir in dream_comics_dir.iterdir():
-        if not session_dir.is_dir():
-            continue
-        
-        metadata_file = session_dir / "metadata.json"
-        if metadata_file.exists():
-            try:
-                with open(metadata_file, 'r') as f:
-                    metadata = json.load(f)
-                generations.append(metadata)
-            except:
-                # Skip if metadata can't be loaded
-                pass
-    
-    # Sort by timestamp, newest first
-    generations.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-    return generations
-
-# Function to display a comic from stored metadata
-def display_comic_from_metadata(metadata):
-    st.subheader("DREAM COMIC")
-    st.write(f"Session ID: {metadata['session_id']}")
-    st.write(f"Generated on: {metadata['timestamp']}")
-    st.write(f"Prompt: {metadata['prompt']}")
-    st.markdown("---")
+st.markdown(FIXED_HEIGHT_CSS, unsafe_allow_html=True)
+
+# Callback for the delete button in the main view, run before the script reruns
+def _on_delete_session(session_id):
+    if delete_session(session_id):
+        st.toast(f"Deleted session {session_id}")
+
+# Function to rerun after a history change, redrawing the main area only if its comic is gone
+def _rerun_after_history_change(was_viewing):
+    if was_viewing and st.session_state.selected_session is None:
+        st.rerun()
+    st.rerun(scope="fragment")
+
+# Sidebar history list, run as a fragment so deleting entries only reruns the sidebar
+@st.fragment
+def _sidebar_history():
+    st.subheader("History")
+    was_viewing = st.session_state.selected_session is not None
     
-    # Get response data from metadata
-    response_data = metadata['response_data']
-    session_id = metadata['session_id']
+    # Delete all history button
+    delete_all_col1, delete_all_col2 = st.columns([3, 1])
+    with delete_all_col1:
+        st.write("Delete all history:")
+        st.write("刪除所有歷史記錄->")
+    with delete_all_col2:
+        if st.button("🗑️ All", help="Delete all history"):
+            st.session_state.confirm_delete_all = True
     
-    # Create a 2x2 grid layout for panels
-    row1_col1, row1_col2 = st.columns(2)
-    row2_col1, row2_col2 = st.columns(2)
+    # Ask for confirmation before wiping everything
+    if st.session_state.confirm_delete_all:
+        st.warning("Delete all history? 確定刪除所有歷史記錄？")
+        confirm_col, cancel_col = st.columns(2)
+        with confirm_col:
+            if st.button("Delete", key="confirm_delete_all_yes"):
+                st.session_state.confirm_delete_all = False
+                if delete_all_history():
+                    st.toast("All history deleted")
+                _rerun_after_history_change(was_viewing)
+        with cancel_col:
+            if st.button("Cancel", key="confirm_delete_all_no"):
+                st.session_state.confirm_delete_all = False
+                st.rerun(scope="fragment")
     
-    # Panel 1 (top-left)
-    with row1_col1:
-        st.subheader("Panel 1")
-        st.markdown("**Description:**")
-        fixed_height_container(response_data['panels']['panel1']['description'])
-        st.markdown("**Chinese Description:**")
-        fixed_height_container(response_data['panels']['panel1']['chinese'])
-        display_image_from_url(response_data['panels']['panel1']['image_url'], 1, session_id)
+    # Get and display previous generations
+    previous_generations = get_previous_generations()
+    if not previous_generations:
+        st.text("No previous generations found")
+        return
     
-    # Display panels 2-4 similarly
-    with row1_col2:
-        st.subheader("Panel 2")
-        st.markdown("**Description:**")
-        fixed_height_container(response_data['panels']['panel2']['description'])
-        st.markdown("**Chinese Description:**")
-        fixed_height_container(response_data['panels']['panel2']['chinese'])
-        display_image_from_url(response_data['panels']['panel2']['image_url'], 2, session_id)
-    
-    with row2_col1:
-        st.subheader("Panel 3")
-        st.markdown("**Description:**")
-        fixed_height_container(response_data['panels']['panel3']['description'])
-        st.markdown("**Chinese Description:**")
-        fixed_height_container(response_data['panels']['panel3']['chinese'])
-        display_image_from_url(response_data['panels']['panel3']['image_url'], 3, session_id)
-    
-    with row2_col2:
-        st.subheader("Panel 4")
-        st.markdown("**Description:**")
-        fixed_height_container(response_data['panels']['panel4']['description'])
-        st.markdown("**Chinese Description:**")
-        fixed_height_container(response_data['panels']['panel4']['chinese'])
-        display_image_from_url(response_data['panels']['panel4']['image_url'], 4, session_id)
-
-# Function to display image from URL or local file
-def display_image_from_url(image_url, panel_num, session_id):
-    try:
-        # Check if image exists locally first
-        save_dir = Path(__file__).parent / "dream_comics" / session_id
-        local_path = save_dir / f"panel_{panel_num}.png"
-        
-        if local_path.exists():
-            # Load the saved image
-            image = Image.open(local_path)
-            st.image(image, caption=f"Panel {panel_num}", use_container_width=True)
-            return True
-        
-        # If not local, get the image from URL
-        response = requests.get(f"{url}{image_url}")
-        if response.status_code == 200:
-            # Create an image from the response content
-            image = Image.open(io.BytesIO(response.content))
-            
-            # Save the image
-            save_dir.mkdir(parents=True, exist_ok=True)
-            image.save(local_path)
-            
-            # Display the image
-            st.image(image, caption=f"Panel {panel_num}", use_container_width=True)
-            return True
-        else:
-            st.error(f"Failed to fetch image {panel_num}. Status code: {response.status_code}")
-            return False
-    except Exception as e:
-        st.error(f"Error displaying image {panel_num}: {e}")
-        return False
-
-# Add sidebar for navigation
-st.sidebar.title("Dream Comic Navigator")
-
-# Button to generate new comics
-if st.sidebar.button("Create New Comic"):
-    st.session_state.view_mode = 'new'
-    st.session_state.selected_session = None
-
-# Display history section in sidebar
-st.sidebar.subheader("History")
-
-# Delete all history button
-delete_all_col1, delete_all_col2 = st.sidebar.columns([3, 1])
-with delete_all_col1:
-    st.write("Delete all history:")
-    st.write("刪除所有歷史記錄->")
-with delete_all_col2:
-    if st.button("🗑️ All", help="Delete all history"):
-        if delete_all_history():
-            st.sidebar.success("All history deleted")
-            st.session_state.refresh_history = True
-
-# Get and display previous generations
-previous_generations = get_previous_generations()
-if not previous_generations:
-    st.sidebar.text("No previous generations found")
-else:
-    # Force refresh if needed
-    if st.session_state.refresh_history:
-        st.session_state.refresh_history = False
-        st.experimental_rerun()
-        
     # Display history items with delete buttons
     for idx, gen in enumerate(previous_generations):
         session_id = gen.get('session_id', '')
         timestamp = gen.get('timestamp', 'Unknown date')
         prompt_preview = gen.get('prompt', '')[:30] + '...' if len(gen.get('prompt', '')) > 30 else gen.get('prompt', '')
         
-        col1, col2 = st.sidebar.columns([4, 1])
+        col1, col2 = st.columns([4, 1])
         
-        # View button
+        # View button, which has to redraw the main area
         with col1:
             if st.button(f"{timestamp}: {prompt_preview}", key=f"history_{idx}"):
                 st.session_state.view_mode = 'history'
                 st.session_state.selected_session = gen
+                st.rerun()
         
         # Delete button
         with col2:
             if st.button("🗑️", key=f"delete_{idx}", help=f"Delete this entry"):
                 if delete_session(session_id):
-                    st.sidebar.success(f"Deleted session {session_id}")
-                    st.session_state.refresh_history = True
-                    st.experimental_rerun()
+                    st.toast(f"Deleted session {session_id}")
+                    _rerun_after_history_change(was_viewing)
+
+# Pending generation, polled every second until the worker thread finishes
+@st.fragment(run_every=1)
+def _generation_status():
+    future = st.session_state.gen_future
+    if not future.done():
+        st.info("Generating your dream comic... This may take a minute...")
+        if st.button("Cancel", key="cancel_generation"):
+            # A request that is already running cannot be interrupted; its result is dropped
+            future.cancel()
+            st.session_state.gen_future = None
+            st.rerun()
+        return
+    
+    st.session_state.gen_future = None
+    try:
+        response = future.result()
+
+        # Parse the response
+        response_data = orjson.loads(response.content)
+        
+        # Store session_id for image saving
+        session_id = response_data['session_id']
+        
+        # Save metadata for this generation
+        save_generation_metadata(session_id, st.session_state.gen_prompt, response_data)
+        
+        # Download all four panel images before rendering
+        fetch_panel_images(response_data, session_id)
+        
+        st.session_state.gen_result = response_data
+    except requests.exceptions.Timeout:
+        st.session_state.gen_error = "Request timed out. The server took too long to respond."
+    except Exception as e:
+        st.session_state.gen_error = f"An error occurred: {e}"
+    # Redraw the whole page so the results render outside this fragment
+    st.rerun()
+
+# Add sidebar for navigation
+st.sidebar.title("Dream Comic Navigator")
+
+# Button to generate new comics
+if st.sidebar.button("Create New Comic"):
+    st.session_state.view_mode = 'new'
+    st.session_state.selected_session = None
+
+# Display history section in sidebar
+with st.sidebar:
+    _sidebar_history()
 
 # Main content area
 if st.session_state.view_mode == 'history' and st.session_state.selected_session:
@@ -260,12 +159,8 @@ if st.session_state.view_mode == 'history' and st.session_state.selected_session
     display_comic_from_metadata(st.session_state.selected_session)
     
     # Add delete button for current view
-    if st.button("Delete This Comic"):
-        session_id = st.session_state.selected_session.get('session_id')
-        if delete_session(session_id):
-            st.success(f"Deleted session {session_id}")
-            st.session_state.refresh_history = True
-            st.experimental_rerun()
+    st.button("Delete This Comic", on_click=_on_delete_session,
+              args=(st.session_state.selected_session.get('session_id'),))
 else:
     # Default view - new comic generation
     st.title("Dream Comic Generator")
@@ -274,79 +169,33 @@ else:
     # User input via Streamlit
     prompt = st.text_area("Enter your dream text: 輸入您的夢境描述：", height=100)
 
-    # Generate comic when button is clicked
+    # Submit the generate request when button is clicked; it runs on a worker thread
+    # so the script thread stays free for other interactions while the server works
     if st.button("Generate Comic"):
         if prompt:
-            with st.spinner("Generating your dream comic... This may take a minute..."):
-                data = {'dream_text': prompt}
-
-                try:
-                    response = requests.post(f"{url}/api/generate-comic", data=data, timeout=600)
-
-                    # Parse and display the response
-                    response_data = response.json()
-                    
-                    # Store session_id for image saving
-                    session_id = response_data['session_id']
-                    
-                    # Save metadata for this generation
-                    save_generation_metadata(session_id, prompt, response_data)
-                    
-                    st.subheader("DREAM COMIC GENERATION RESULTS")
-                    st.write(f"Session ID: {response_data['session_id']}")
-                    st.markdown("---")
-
-                    # Create a 2x2 grid layout for panels
-                    row1_col1, row1_col2 = st.columns(2)
-                    row2_col1, row2_col2 = st.columns(2)
-                    
-                    # Panel 1 (top-left)
-                    with row1_col1:
-                        st.subheader("Panel 1")
-                        st.markdown("**Description:**")
-                        fixed_height_container(response_data['panels']['panel1']['description'])
-                        st.markdown("**Chinese Description:**")
-                        fixed_height_container(response_data['panels']['panel1']['chinese'])
-                        image_url = response_data['panels']['panel1']['image_url']
-                        display_image_from_url(image_url, 1, session_id)
-                    
-                    # Panel 2 (top-right)
-                    with row1_col2:
-                        st.subheader("Panel 2")
-                        st.markdown("**Description:**")
-                        fixed_height_container(response_data['panels']['panel2']['description'])
-                        st.markdown("**Chinese Description:**")
-                        fixed_height_container(response_data['panels']['panel2']['chinese'])
-                        image_url = response_data['panels']['panel2']['image_url']
-                        display_image_from_url(image_url, 2, session_id)
-                    
-                    # Panel 3 (bottom-left)
-                    with row2_col1:
-                        st.subheader("Panel 3")
-                        st.markdown("**Description:**")
-                        fixed_height_container(response_data['panels']['panel3']['description'])
-                        st.markdown("**Chinese Description:**")
-                        fixed_height_container(response_data['panels']['panel3']['chinese'])
-                        image_url = response_data['panels']['panel3']['image_url']
-                        display_image_from_url(image_url, 3, session_id)
-                    
-                    # Panel 4 (bottom-right)
-                    with row2_col2:
-                        st.subheader("Panel 4")
-                        st.markdown("**Description:**")
-                        fixed_height_container(response_data['panels']['panel4']['description'])
-                        st.markdown("**Chinese Description:**")
-                        fixed_height_container(response_data['panels']['panel4']['chinese'])
-                        image_url = response_data['panels']['panel4']['image_url']
-                        display_image_from_url(image_url, 4, session_id)
-
-                    st.markdown("---")
-                    save_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'dream_comics', session_id))
-                    st.success(f"All images saved to: {save_path}")
-                
-                except requests.exceptions.Timeout:
-                    st.error("Request timed out. The server took too long to respond.")
-                except Exception as e:
-                    st.error(f"An error occurred: {e}")
+            st.session_state.gen_future = run_in_background(
+                SESSION.post, f"{url}/api/generate-comic", data={'dream_text': prompt}, timeout=600
+            )
+            st.session_state.gen_prompt = prompt
+            st.session_state.gen_result = None
+            st.session_state.gen_error = None
         else:
             st.warning("Please enter your dream text first.")
+    
+    if st.session_state.gen_future is not None:
+        _generation_status()
+    elif st.session_state.gen_error:
+        st.error(st.session_state.gen_error)
+    elif st.session_state.gen_result:
+        response_data = st.session_state.gen_result
+        session_id = response_data['session_id']
+        
+        st.subheader("DREAM COMIC GENERATION RESULTS")
+        st.write(f"Session ID: {session_id}")
+        st.markdown("---")
+
+        # Create a 2x2 grid layout for panels
+        render_panels(response_data, session_id)
+
+        st.markdown("---")
+        st.success(f"All images saved to: {PANELS_DIR / session_id}")
@@ -1,16 +1,30 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import orjson
 import argparse
 import os
+import re
+import errno
 import io
 import base64
-from PIL import Image
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Callable, Tuple
 from dotenv import load_dotenv
 from groq import Groq
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, send_file
 from werkzeug.utils import secure_filename
+from waitress import serve
 import uuid
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, Future
+import zipfile
+import hashlib
+import shutil
+import sqlite3
+from contextlib import closing
+from functools import lru_cache
 
 load_dotenv()
 
@@ -24,11 +38,239 @@ os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
 
+# Longest dream description accepted by the API, in characters
+MAX_DREAM_TEXT_LENGTH = 4000
+
+# Generated sessions and uploads are removed once they are older than this many seconds
+SESSION_MAX_AGE = 3600
+JANITOR_INTERVAL = 600
+
+# Cache of translations and generated images, keyed by a hash of their inputs
+CACHE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+os.makedirs(os.path.join(CACHE_FOLDER, 'images'), exist_ok=True)
+CACHE_DB = os.path.join(CACHE_FOLDER, 'cache.sqlite3')
+with closing(sqlite3.connect(CACHE_DB)) as db, db:
+    db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+# Bounds of the cache, enforced by the janitor: cached images unused for longer than
+# CACHE_MAX_AGE seconds are removed, then the least recently used ones until the images
+# fit in CACHE_MAX_BYTES, and only the newest CACHE_MAX_ENTRIES rows are kept
+CACHE_MAX_AGE = 7 * 24 * 3600
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+CACHE_MAX_ENTRIES = 10000
+
 # AI Endpoint configurations
 TEXT_GEN_URL = "http://localhost:5001"
 STABLE_DIFFUSION_URL = "http://localhost:7861"
+
+# Default txt2img settings: a fast multistep sampler converges in fewer steps, a lower
+# CFG scale keeps prompts on track without oversaturating, and 512x512 without hires fix
+# is the native SD 1.x resolution, so each panel needs a single small U-Net pass
+SD_SAMPLER = "DPM++ 2M Karras"
+SD_STEPS = 15
+SD_CFG_SCALE = 5.0
+SD_WIDTH = 512
+SD_HEIGHT = 512
+
+# Optional StreamDiffusion service that denoises all panels of a comic as one batch,
+# e.g. "http://localhost:7862"; when unset, images come from the WebUI above
+STREAM_DIFFUSION_URL = os.getenv("STREAM_DIFFUSION_URL")
+STREAM_DIFFUSION_STEPS = 4
+
+# Optional proxy in front of the WebUI that answers POST /txt2img with the raw image bytes
+# instead of base64 inside JSON, e.g. "http://localhost:7863"
+SD_IMAGE_PROXY_URL = os.getenv("SD_IMAGE_PROXY_URL")
+
+# Persistent HTTP sessions so calls to the local backends reuse keep-alive connections
+_tg_session = requests.Session()
+_tg_session.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=16))
+_sd_session = requests.Session()
+_sd_session.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=16))
+# Request bodies are encoded with orjson and sent as data=, so label them as JSON
+_tg_session.headers["Content-Type"] = "application/json"
+_sd_session.headers["Content-Type"] = "application/json"
+
+# Shared workers that decode and write returned images. Threads rather than processes:
+# decoding a panel takes about a millisecond and the file writes release the GIL, so
+# copying the base64 data to a worker process would cost more than it frees up
+_image_pool = ThreadPoolExecutor(max_workers=4)
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 groq_client = Groq(api_key=GROQ_API_KEY)
+TRANSLATION_MODEL = "llama-3.3-70b-versatile"
+
+# System prompt shared by every comic; it is always sent first and unchanged, so backends
+# with prompt caching can reuse the processed prefix across requests
+_SYSTEM_MSG = {
+    "role": "system",
+    "content": "You are a creative dream interpreter and comic creator. Generate descriptions for four sequential comic panels that continue the dream narrative. Format your response with numbered panels: 'Panel 1:', 'Panel 2:', etc. Example: 'Panel 1: Male furry Lycanthrope with fur-covered body in ancient ruins, howling at the full moon, surrounded by eerie mist, werewolf transformation, elder scrolls, eslweyr, glitch aesthetic, anime-inspired, digital illustration, artstation, furry' The generated prompt show not include any moving elements or dialogue."
+}
+
+# Panel headers at the start of a line, e.g. "Panel 1:", "**Panel 2:**", "- Panel 3 -",
+# "1. Panel 1:" or "Panel 4 (The Escape):"; like a plain split on the first colon, any
+# title before a colon on the header line is dropped
+_PANEL_RE = re.compile(
+    r'^[\s*#_]*(?:(?:[-•+]|\d+[.)])[\s*#_]*)?Panel\s*([1-4])\b(?:[^:\n]*:|[\s*_]*-)?[\s*_]*',
+    re.IGNORECASE | re.MULTILINE
+)
+
+def cache_key(*parts: str) -> str:
+    """Hash the inputs of a cached result into a cache key"""
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+def read_cache(key: str) -> Optional[str]:
+    """Read a value straight from the disk cache, or None if nothing is cached under key"""
+    try:
+        with closing(sqlite3.connect(CACHE_DB)) as db:
+            row = db.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+    except sqlite3.Error as e:
+        # The cache is only an optimization; treat an unreadable database as a miss
+        print(f"Error reading cache: {str(e)}")
+        return None
+    return row[0] if row else None
+
+@lru_cache(maxsize=1024)
+def cache_lookup(key: str) -> str:
+    """
+    Look up a cached value that never changes once stored, keeping hits in memory
+    so repeats skip the database
+    
+    Args:
+        key: Cache key from cache_key()
+        
+    Returns:
+        The cached value
+        
+    Raises:
+        KeyError: If nothing is cached under the key (misses are not memoized)
+    """
+    value = read_cache(key)
+    if value is None:
+        raise KeyError(key)
+    return value
+
+def cache_store(key: str, value: str, replace: bool = False) -> None:
+    """
+    Store a value in the disk cache
+    
+    Args:
+        key: Cache key from cache_key()
+        value: Value to store
+        replace: Overwrite an existing value; only for keys read with read_cache(),
+            since cache_lookup() may still hold the old value in memory
+    """
+    try:
+        with closing(sqlite3.connect(CACHE_DB)) as db, db:
+            db.execute(f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO cache (key, value) VALUES (?, ?)", (key, value))
+    except sqlite3.Error as e:
+        # A result that can't be cached is still a valid result
+        print(f"Error writing cache: {str(e)}")
+
+def image_cache_key(prompt: str, settings: Dict[str, Any]) -> str:
+    """Cache key of an image generated from prompt with the given txt2img settings"""
+    return cache_key("txt2img", prompt, json.dumps(settings, sort_keys=True))
+
+def load_cached_image(prompt: str, settings: Dict[str, Any], output_path: str) -> Optional[str]:
+    """
+    Copy a previously generated image for the same prompt to output_path
+    
+    Returns:
+        Path to the copied image, with the cached image's extension,
+        or None if no cached image exists
+    """
+    try:
+        cache_path = cache_lookup(image_cache_key(prompt, settings))
+        output_path = os.path.splitext(output_path)[0] + os.path.splitext(cache_path)[1]
+        link_or_copy(cache_path, output_path)
+        # Mark the cached image as recently used so pruning keeps it
+        os.utime(cache_path)
+    except (KeyError, OSError):
+        return None
+    
+    print(f"Cached image copied to: {output_path}")
+    return output_path
+
+def store_cached_image(prompt: str, settings: Dict[str, Any], image_path: str) -> None:
+    """Keep a copy of a generated image so the same prompt can reuse it"""
+    key = image_cache_key(prompt, settings)
+    cache_path = os.path.join(CACHE_FOLDER, 'images', key + os.path.splitext(image_path)[1])
+    try:
+        link_or_copy(image_path, cache_path)
+        cache_store(key, cache_path)
+    except OSError as e:
+        print(f"Error caching image: {str(e)}")
+
+# Errors from os.link that mean the filesystem can't hard link these files
+_LINK_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EMLINK}
+
+def link_or_copy(src: str, dst: str) -> None:
+    """
+    Hard link src to dst so the image is stored once, copying where links aren't possible
+    
+    An existing dst may be linked into a session another client was already given,
+    so it is replaced with a new file rather than written in place.
+    """
+    tmp_path = f"{dst}.{uuid.uuid4().hex}.part"
+    try:
+        try:
+            os.link(src, tmp_path)
+        except OSError as e:
+            if e.errno not in _LINK_UNSUPPORTED:
+                raise
+            shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def prune_cache(max_age: float = CACHE_MAX_AGE, max_bytes: int = CACHE_MAX_BYTES, max_entries: int = CACHE_MAX_ENTRIES) -> int:
+    """
+    Keep the cache within its bounds
+    
+    Drops all but the newest max_entries rows, then removes cached images that no row
+    refers to, that were last used more than max_age seconds ago, or that are the least
+    recently used beyond max_bytes, together with their rows.
+    
+    Args:
+        max_age: Seconds after which an unused cached image is removed
+        max_bytes: Total size the cached images may take up
+        max_entries: Number of cache rows to keep
+        
+    Returns:
+        Number of cached images removed
+    """
+    with closing(sqlite3.connect(CACHE_DB)) as db, db:
+        # Rows are replaced with a new rowid, so the highest rowids are the newest entries
+        db.execute("DELETE FROM cache WHERE rowid <= (SELECT MAX(rowid) FROM cache) - ?", (max_entries,))
+        referenced = {row[0] for row in db.execute("SELECT value FROM cache")}
+    
+    images_dir = os.path.join(CACHE_FOLDER, 'images')
+    with os.scandir(images_dir) as entries:
+        images = sorted(
+            ((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries if entry.is_file()),
+            reverse=True
+        )
+    
+    now = time.time()
+    total = 0
+    expired = []
+    # Newest first, so whatever no longer fits is the least recently used
+    for mtime, size, path in images:
+        total += size
+        # Images written in the last minute may not have their row yet
+        orphaned = path not in referenced and mtime < now - 60
+        if orphaned or mtime < now - max_age or total > max_bytes:
+            expired.append(path)
+    
+    for path in expired:
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"Error removing {path}: {str(e)}")
+    if expired:
+        with closing(sqlite3.connect(CACHE_DB)) as db, db:
+            db.executemany("DELETE FROM cache WHERE value = ?", [(path,) for path in expired])
+    return len(expired)
 
 def translate_to_traditional_chinese(text: str) -> str:
     """
@@ -51,7 +293,7 @@ def translate_to_traditional_chinese(text: str) -> str:
                     "content": prompt
                 }
             ],
-            model="llama-3.3-70b-versatile",
+            model=TRANSLATION_MODEL,
         )
 
         return response.choices[0].message.content
@@ -60,6 +302,95 @@ def translate_to_traditional_chinese(text: str) -> str:
         print(f"Error during translation: {str(e)}")
         return text
 
+def translate_panels_batch(panels: List[str]) -> List[str]:
+    """
+    Translate several panel descriptions to Traditional Chinese with a single Groq request
+    
+    Args:
+        panels: Texts to translate
+        
+    Returns:
+        Translated texts in the same order as the input
+    """
+    numbered = "\n".join(f"{i}. {text}" for i, text in enumerate(panels, 1))
+    prompt = (
+        f"Translate each of the following {len(panels)} English descriptions to Traditional Chinese. "
+        "Reply as JSON mapping each number to its translation, e.g. {\"1\": \"...\", \"2\": \"...\"}.\n"
+        f"{numbered}"
+    )
+    
+    try:
+        print(f"Sending batch translation request for {len(panels)} panels...")
+        response = groq_client.chat.completions.create(
+            messages=[
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ],
+            model=TRANSLATION_MODEL,
+            response_format={"type": "json_object"},
+        )
+        
+        translations = orjson.loads(response.choices[0].message.content)
+        result = [translations[str(i)] for i in range(1, len(panels) + 1)]
+        if not all(isinstance(text, str) for text in result):
+            raise ValueError("Unexpected translation format")
+        return result
+    
+    except Exception as e:
+        # Fall back to one request per panel if the batched reply can't be used
+        print(f"Error during batch translation, translating panels individually: {str(e)}")
+        return [translate_to_traditional_chinese(text) for text in panels]
+
+class TranslationBatcher:
+    """
+    Coalesce translation requests from concurrent comics into shared Groq requests
+    
+    Texts are collected until max_batch are waiting or max_wait seconds have passed
+    since the first one, then translated together with translate_panels_batch().
+    """
+    
+    def __init__(self, max_wait: float = 0.05, max_batch: int = 16):
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        # Batches are sent from a small pool so collecting the next batch never waits on Groq
+        self._executor = ThreadPoolExecutor(max_workers=4)
+        threading.Thread(target=self._collect, daemon=True).start()
+    
+    def translate(self, text: str) -> Future:
+        """Queue a text for translation; the future resolves to its Traditional Chinese translation"""
+        future = Future()
+        self._queue.put((text, future))
+        return future
+    
+    def _collect(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._send, batch)
+    
+    def _send(self, batch: List[Tuple[str, Future]]) -> None:
+        try:
+            translations = translate_panels_batch([text for text, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), translated in zip(batch, translations):
+            future.set_result(translated)
+
+translation_batcher = TranslationBatcher()
+
 def generate_dream_comic(
     dream_text: str = "",
     output_file: Optional[str] = None,
@@ -68,10 +399,9 @@ def generate_dream_comic(
     translate_to_chinese: bool = False
 ) -> Dict[str, Any]:
     """
-    Generate a four-panel comic based on a dream image and/or text description.
+    Generate a four-panel comic based on a dream text description.
     
     Args:
-        image_path: Optional path to an image file representing the dream
         dream_text: Text description of the dream
         output_file: Optional file path to save the results
         generate_images: Whether to generate images for each panel
@@ -83,110 +413,61 @@ def generate_dream_comic(
     """
     # Prepare the messages for the API
     messages = [
-        {
-            "role": "system", 
-            "content": "You are a creative dream interpreter and comic creator. Generate descriptions for four sequential comic panels that continue the dream narrative. Format your response with numbered panels: 'Panel 1:', 'Panel 2:', etc. Example: 'Panel 1: Male furry Lycanthrope with fur-covered body in ancient ruins, howling at the full moon, surrounded by eerie mist, werewolf transformation, elder scrolls, eslweyr, glitch aesthetic, anime-inspired, digital illustration, artstation, furry' The generated prompt show not include any moving elements or dialogue."
-        },
+        _SYSTEM_MSG,
         {
             "role": "user", 
             "content": f"I had this dream: {dream_text}\n\nPlease create four sequential comic panels that continue this dream narrative. For each panel, provide a clear, detailed description of what should be depicted."
         }
     ]
     
-    files = {}
-    # Add image if provided
-    if image_path and os.path.exists(image_path):
-        files = {"image": open(image_path, "rb")}
-        print(f"Including dream image: {image_path}")
-    
     try:
-        # Call the combined analysis endpoint as it handles both image and text
-        # Updated to match the API expectations
-        response = requests.post(
-            url = f"{TEXT_GEN_URL}/v1/chat/completions",
-            json= {
-                "mode": "instruct", 
-                "stream": "false",
-                "messages": messages,
-            }
-        )
-        
-        if response.status_code != 200:
-            print(f"Error: {response.status_code} - {response.text}")
-            return {"error": response.text}
-        
-        print("Dream comic description generation complete.")
-        result = response.json()
-        
-        
-        # Check different possible response structures
-        if "choices" in result and len(result["choices"]) > 0:
-            if "message" in result["choices"][0] and "content" in result["choices"][0]["message"]:
-                content = result["choices"][0]["message"]["content"]
-            else:
-                content = result["choices"][0].get("content", "")
-        elif "content" in result:
-            content = result["content"]
-        else:
-            # If we can't find the content in expected places, use the whole result as a string
-            content = str(result)
-            print("Warning: Unexpected response format. Using full response as content.")
-        
-        # Extract panel descriptions from the generated content
-        print("\nExtracting panel descriptions from response...")
-        comic_panels = extract_panels(content)
-        print("Panel extraction complete.")
-        
-        # Generate images for each panel if requested
         if generate_images:
             if not output_dir:
                 output_dir = os.path.dirname(output_file) if output_file else "."
             
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-            
-            # Generate images for each panel
-            for i in range(1, 5):
-                panel_key = f"panel{i}"
-                image_path = os.path.join(output_dir, f"panel_{i}.png")
-                
-                # Only generate if we have valid content
-                if comic_panels[panel_key] and "[Panel" not in comic_panels[panel_key]:
-                    print(f"Generating image for panel {i}...")
-                    img_path = generate_image(comic_panels[panel_key], image_path)
-                    if img_path:
-                        comic_panels[f"{panel_key}_image"] = img_path
-                    else:
-                        comic_panels[f"{panel_key}_image"] = "Failed to generate image"
-                else:
-                    comic_panels[f"{panel_key}_image"] = "No valid description for image generation"
+            os.makedirs(output_dir, exist_ok=True)
         
-        # Translate panel descriptions to Traditional Chinese if requested
-        if translate_to_chinese:
-            print("\nBeginning translation process for individual panels...")
+        # One worker per panel image plus one for the translation, so the translation
+        # never queues behind the images
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            image_futures = {}
             
-            # Process each panel independently
-            for i in range(1, 5):
-                panel_key = f"panel{i}"
-                panel_description = comic_panels[panel_key]
-                
-                # Skip translation if the panel description is not valid
-                if not panel_description or "[Panel" in panel_description:
-                    print(f"Panel {i}: No valid description found for translation")
-                    comic_panels[f"{panel_key}_chinese"] = "Translation not available"
-                    continue
-                
-                print(f"\nPanel {i} translation:")
-                print(f"Original: {panel_description}")
-                
-                # Send this specific panel description for translation
-                translated_description = translate_to_traditional_chinese(panel_description)
-                comic_panels[f"{panel_key}_chinese"] = translated_description
-                
-                print(f"Translation complete for Panel {i}")
-                print(f"Translated: {translated_description[:100]}..." if len(translated_description) > 100 else f"Translated: {translated_description}")
+            # Start each panel's image as soon as its description has streamed in,
+            # so Stable Diffusion works while the remaining panels are still being written
+            def dispatch_panel(panel_key: str, description: str) -> None:
+                # StreamDiffusion is fastest with all panels in one batch, so it waits for the full text
+                if generate_images and not STREAM_DIFFUSION_URL and description and "[Panel" not in description:
+                    image_path = os.path.join(output_dir, f"panel_{panel_key[-1]}.png")
+                    image_futures[panel_key] = executor.submit(generate_image, description, image_path)
+            
+            content = request_comic_text(messages, dispatch_panel)
+            print("Dream comic description generation complete.")
+            
+            # Extract panel descriptions from the generated content
+            print("\nExtracting panel descriptions from response...")
+            comic_panels = extract_panels(content)
+            print("Panel extraction complete.")
+            
+            # Translate panel descriptions to Traditional Chinese if requested,
+            # while the images are still being generated
+            translation = executor.submit(translate_panels, comic_panels) if translate_to_chinese else None
             
-            print("\nAll panel translations completed.")
+            # Generate images for each panel if requested
+            if generate_images:
+                if image_futures:
+                    for i in range(1, 5):
+                        panel_key = f"panel{i}"
+                        if panel_key not in image_futures:
+                            comic_panels[f"{panel_key}_image"] = "No valid description for image generation"
+                        else:
+                            img_path = image_futures[panel_key].result()
+                            comic_panels[f"{panel_key}_image"] = img_path or "Failed to generate image"
+                else:
+                    # Nothing was dispatched while streaming, e.g. the backend replied in one piece
+                    generate_panel_images(comic_panels, output_dir)
+            
+            if translation:
+                translation.result()
         
         # Save to output file if specified
         if output_file:
@@ -202,35 +483,194 @@ def generate_dream_comic(
     except Exception as e:
         print(f"Error generating dream comic: {str(e)}")
         return {"error": str(e)}
-    finally:
-        # Close the image file if it was opened
-        if files and "image" in files:
-            files["image"].close()
+
+def generate_panel_images(comic_panels: Dict[str, str], output_dir: str) -> None:
+    """
+    Generate an image for each panel with a valid description
+    
+    Args:
+        comic_panels: Panel descriptions; image paths are added under "panelN_image"
+        output_dir: Directory to save the generated images
+    """
+    settings = {"stream_batch": True, "steps": STREAM_DIFFUSION_STEPS} if STREAM_DIFFUSION_URL else image_settings()
+    
+    # Collect the panels that have valid content to generate images for
+    jobs = []
+    for i in range(1, 5):
+        panel_key = f"panel{i}"
+        image_path = os.path.join(output_dir, f"panel_{i}.png")
+        
+        # Only generate if we have valid content
+        if not comic_panels[panel_key] or "[Panel" in comic_panels[panel_key]:
+            comic_panels[f"{panel_key}_image"] = "No valid description for image generation"
+        else:
+            cached_path = load_cached_image(comic_panels[panel_key], settings, image_path)
+            if cached_path:
+                comic_panels[f"{panel_key}_image"] = cached_path
+            else:
+                jobs.append((panel_key, comic_panels[panel_key], image_path))
+    
+    # Generate all images with one Stable Diffusion request
+    print(f"Generating images for {len(jobs)} panels...")
+    prompts = [prompt for _, prompt, _ in jobs]
+    paths = [path for _, _, path in jobs]
+    results = generate_images_stream_batch(prompts, paths, settings) if jobs and STREAM_DIFFUSION_URL else None
+    if results is None:
+        results = generate_images_batch(prompts, paths) if jobs else []
+    
+    if results is not None:
+        for (panel_key, _, _), img_path in zip(jobs, results):
+            if img_path:
+                comic_panels[f"{panel_key}_image"] = img_path
+            else:
+                comic_panels[f"{panel_key}_image"] = "Failed to generate image"
+    else:
+        # Fall back to one request per panel, sent in parallel
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = {
+                executor.submit(generate_image, prompt, path): panel_key
+                for panel_key, prompt, path in jobs
+            }
+            for future in as_completed(futures):
+                panel_key = futures[future]
+                img_path = future.result()
+                if img_path:
+                    comic_panels[f"{panel_key}_image"] = img_path
+                else:
+                    comic_panels[f"{panel_key}_image"] = "Failed to generate image"
+
+def translate_panels(comic_panels: Dict[str, str]) -> None:
+    """
+    Translate each panel with a valid description to Traditional Chinese
+    
+    Args:
+        comic_panels: Panel descriptions; translations are added under "panelN_chinese"
+    """
+    print("\nBeginning translation process for all panels...")
+    
+    # Collect the panels that have a valid description
+    panel_keys = []
+    for i in range(1, 5):
+        panel_key = f"panel{i}"
+        panel_description = comic_panels[panel_key]
+        
+        # Skip translation if the panel description is not valid
+        if not panel_description or "[Panel" in panel_description:
+            print(f"Panel {i}: No valid description found for translation")
+            comic_panels[f"{panel_key}_chinese"] = "Translation not available"
+            continue
+        
+        panel_keys.append(panel_key)
+    
+    # Reuse earlier translations of the same descriptions
+    translations = {}
+    for panel_key in panel_keys:
+        try:
+            translations[panel_key] = cache_lookup(cache_key(TRANSLATION_MODEL, comic_panels[panel_key]))
+        except KeyError:
+            pass
+    
+    # Queue the remaining panel descriptions; they are translated together with
+    # those of any other comics being generated at the same time
+    futures = {
+        panel_key: translation_batcher.translate(comic_panels[panel_key])
+        for panel_key in panel_keys if panel_key not in translations
+    }
+    for panel_key, future in futures.items():
+        translated_description = future.result()
+        translations[panel_key] = translated_description
+        # A failed translation comes back as the original text; don't cache that
+        if translated_description != comic_panels[panel_key]:
+            cache_store(cache_key(TRANSLATION_MODEL, comic_panels[panel_key]), translated_description)
+    
+    for panel_key in panel_keys:
+        translated_description = translations[panel_key]
+        comic_panels[f"{panel_key}_chinese"] = translated_description
+        
+        print(f"\n{panel_key} translation:")
+        print(f"Translated: {translated_description[:100]}..." if len(translated_description) > 100 else f"Translated: {translated_description}")
+    
+    print("\nAll panel translations completed.")
+
+def extract_content(result: Dict[str, Any]) -> str:
+    """Extract the generated text from a non-streamed completion response"""
+    # Check different possible response structures
+    if "choices" in result and len(result["choices"]) > 0:
+        if "message" in result["choices"][0] and "content" in result["choices"][0]["message"]:
+            return result["choices"][0]["message"]["content"]
+        return result["choices"][0].get("content", "")
+    if "content" in result:
+        return result["content"]
+    
+    # If we can't find the content in expected places, use the whole result as a string
+    print("Warning: Unexpected response format. Using full response as content.")
+    return str(result)
+
+def request_comic_text(messages: List[Dict[str, str]], on_panel: Callable[[str, str], None]) -> str:
+    """
+    Stream the panel descriptions from the text generation API
+    
+    Each panel is handed to on_panel as soon as the header of the next panel arrives,
+    and the last one when the stream ends.
+    
+    Args:
+        messages: Chat messages to send to the model
+        on_panel: Called with the panel key and its description once the panel is complete
+        
+    Returns:
+        The full generated content
+    """
+    with _tg_session.post(
+        url = f"{TEXT_GEN_URL}/v1/chat/completions",
+        data= orjson.dumps({
+            "mode": "instruct", 
+            "stream": True,
+            "messages": messages,
+        }),
+        stream=True
+    ) as response:
+        if response.status_code != 200:
+            print(f"Error: {response.status_code} - {response.text}")
+            raise RuntimeError(response.text)
+        
+        # Some backends ignore the stream flag and send the whole completion at once
+        if not response.headers.get("Content-Type", "").startswith("text/event-stream"):
+            return extract_content(orjson.loads(response.content))
+        
+        content = ""
+        completed = 0
+        for line in response.iter_lines(decode_unicode=True):
+            # Server-sent events carry one JSON chunk per "data:" line
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            
+            choices = orjson.loads(data).get("choices") or [{}]
+            delta = choices[0].get("delta", {}).get("content") or ""
+            content += delta
+            
+            # A panel is complete as soon as the next panel's header has started
+            while completed < 3 and delta and str(completed + 2) in _PANEL_RE.findall(content):
+                completed += 1
+                on_panel(f"panel{completed}", extract_panels(content)[f"panel{completed}"])
+    
+    panels = extract_panels(content)
+    for i in range(completed + 1, 5):
+        on_panel(f"panel{i}", panels[f"panel{i}"])
+    
+    return content
 
 def extract_panels(content: str) -> Dict[str, str]:
     """Extract the four panels from the AI-generated content"""
     panels = {}
     
-    # Simple parsing - look for Panel 1, Panel 2, etc.
-    lines = content.split("\n")
-    current_panel = None
-    
-    for line in lines:
-        if "Panel 1:" in line or "Panel 1" in line:
-            current_panel = "panel1"
-            panels[current_panel] = line.split(":", 1)[1].strip() if ":" in line else ""
-        elif "Panel 2:" in line or "Panel 2" in line:
-            current_panel = "panel2"
-            panels[current_panel] = line.split(":", 1)[1].strip() if ":" in line else ""
-        elif "Panel 3:" in line or "Panel 3" in line:
-            current_panel = "panel3"
-            panels[current_panel] = line.split(":", 1)[1].strip() if ":" in line else ""
-        elif "Panel 4:" in line or "Panel 4" in line:
-            current_panel = "panel4"
-            panels[current_panel] = line.split(":", 1)[1].strip() if ":" in line else ""
-        elif current_panel and line.strip():
-            # Append content to current panel
-            panels[current_panel] += " " + line.strip()
+    # Split on the panel headers; parts alternate between panel numbers and their bodies
+    parts = _PANEL_RE.split(content)
+    for number, body in zip(parts[1::2], parts[2::2]):
+        # Join the body's lines into a single description
+        panels[f"panel{number}"] = " ".join(line.strip() for line in body.splitlines() if line.strip())
     
     # Ensure we have all four panels
     for i in range(1, 5):
@@ -240,7 +680,44 @@ def extract_panels(content: str) -> Dict[str, str]:
     
     return panels
 
-def generate_image(prompt: str, output_path: str, steps: int = 20) -> Optional[str]:
+def image_settings(
+    steps: int = SD_STEPS,
+    sampler_name: str = SD_SAMPLER,
+    cfg_scale: float = SD_CFG_SCALE,
+    width: int = SD_WIDTH,
+    height: int = SD_HEIGHT
+) -> Dict[str, Any]:
+    """
+    Build the txt2img generation settings sent with every prompt
+    
+    Args:
+        steps: Number of inference steps (higher = more detail but slower)
+        sampler_name: Name of the sampler to use
+        cfg_scale: How strictly the image follows the prompt
+        width: Image width in pixels
+        height: Image height in pixels
+        
+    Returns:
+        Settings to merge into a txt2img payload
+    """
+    return {
+        "steps": steps,
+        "sampler_name": sampler_name,
+        "cfg_scale": cfg_scale,
+        "width": width,
+        "height": height,
+        "enable_hr": False
+    }
+
+def generate_image(
+    prompt: str,
+    output_path: str,
+    steps: int = SD_STEPS,
+    sampler_name: str = SD_SAMPLER,
+    cfg_scale: float = SD_CFG_SCALE,
+    width: int = SD_WIDTH,
+    height: int = SD_HEIGHT
+) -> Optional[str]:
     """
     Generate an image from a text prompt using Stable Diffusion API
     
@@ -248,30 +725,215 @@ def generate_image(prompt: str, output_path: str, steps: int = 20) -> Optional[s
         prompt: Text description to generate image from
         output_path: Path to save the generated image
         steps: Number of inference steps (higher = more detail but slower)
+        sampler_name: Name of the sampler to use
+        cfg_scale: How strictly the image follows the prompt
+        width: Image width in pixels
+        height: Image height in pixels
         
     Returns:
         Path to the saved image or None if generation failed
     """
+    settings = image_settings(steps, sampler_name, cfg_scale, width, height)
+    
+    # Reuse an earlier image for the same prompt
+    cached_path = load_cached_image(prompt, settings, output_path)
+    if cached_path:
+        return cached_path
+    
     payload = {
         "prompt": prompt,
-        "steps": steps
+        **settings
     }
     
     try:
-        response = requests.post(url=f'{STABLE_DIFFUSION_URL}/sdapi/v1/txt2img', json=payload)
+        if SD_IMAGE_PROXY_URL:
+            saved_path = download_image(payload, output_path)
+        else:
+            response = _sd_session.post(url=f'{STABLE_DIFFUSION_URL}/sdapi/v1/txt2img', data=orjson.dumps(payload))
+            response.raise_for_status()  # Raise exception for 4XX/5XX responses
+            
+            r = orjson.loads(response.content)
+            
+            saved_path = save_image(r['images'][0], output_path)
+        if saved_path:
+            store_cached_image(prompt, settings, saved_path)
+        return saved_path
+    except Exception as e:
+        print(f"Error generating image: {str(e)}")
+        return None
+
+def generate_images_batch(
+    prompts: List[str],
+    output_paths: List[str],
+    steps: int = SD_STEPS,
+    sampler_name: str = SD_SAMPLER,
+    cfg_scale: float = SD_CFG_SCALE,
+    width: int = SD_WIDTH,
+    height: int = SD_HEIGHT
+) -> Optional[List[Optional[str]]]:
+    """
+    Generate one image per prompt with a single Stable Diffusion API request
+    
+    txt2img only takes one prompt per request, so the prompts are submitted through the
+    webui's "Prompts from file or textbox" script, which runs them as a single job.
+    
+    Args:
+        prompts: Text descriptions to generate images from
+        output_paths: Paths to save the generated images, one per prompt
+        steps: Number of inference steps (higher = more detail but slower)
+        sampler_name: Name of the sampler to use
+        cfg_scale: How strictly the images follow the prompts
+        width: Image width in pixels
+        height: Image height in pixels
+        
+    Returns:
+        Paths to the saved images (None for any image that could not be saved),
+        or None if the batch request failed
+    """
+    # The script reads one prompt per line
+    prompt_lines = [prompt.replace("\n", " ") for prompt in prompts]
+    settings = image_settings(steps, sampler_name, cfg_scale, width, height)
+    payload = {
+        # The script joins each line with this prompt, so leave it empty
+        "prompt": "",
+        **settings,
+        "script_name": "prompts from file or textbox",
+        # checkbox_iterate, checkbox_iterate_batch, prompt_position, prompt_txt
+        "script_args": [False, False, "start", "\n".join(prompt_lines)]
+    }
+    
+    try:
+        response = _sd_session.post(url=f'{STABLE_DIFFUSION_URL}/sdapi/v1/txt2img', data=orjson.dumps(payload))
         response.raise_for_status()  # Raise exception for 4XX/5XX responses
         
-        r = response.json()
+        images = orjson.loads(response.content)['images']
+        if len(images) < len(prompts):
+            raise ValueError(f"Expected {len(prompts)} images, got {len(images)}")
+        # A grid image may be returned first; the individual images are the last ones
+        images = images[-len(prompts):]
+    except Exception as e:
+        print(f"Error generating image batch: {str(e)}")
+        return None
+    
+    # Decode and save the images in parallel
+    saved_paths = list(_image_pool.map(save_image, images, output_paths))
+    
+    for prompt, saved_path in zip(prompts, saved_paths):
+        if saved_path:
+            store_cached_image(prompt, settings, saved_path)
+    return saved_paths
+
+def generate_images_stream_batch(prompts: List[str], output_paths: List[str], settings: Dict[str, Any]) -> Optional[List[Optional[str]]]:
+    """
+    Generate one image per prompt with a single request to the StreamDiffusion service
+    
+    The service denoises the latents of all prompts together, one batched U-Net pass per step.
+    It takes {"prompts": [...], "steps": N} and answers {"images": [...]} with one
+    base64-encoded PNG per prompt, in order.
+    
+    Args:
+        prompts: Text descriptions to generate images from
+        output_paths: Paths to save the generated images, one per prompt
+        settings: Generation settings, also used as the image cache key
+        
+    Returns:
+        Paths to the saved images (None for any image that could not be saved),
+        or None if the batch request failed
+    """
+    try:
+        response = _sd_session.post(
+            url=f'{STREAM_DIFFUSION_URL}/batch_txt2img',
+            data=orjson.dumps({"prompts": prompts, "steps": settings["steps"]})
+        )
+        response.raise_for_status()  # Raise exception for 4XX/5XX responses
         
-        image = Image.open(io.BytesIO(base64.b64decode(r['images'][0])))
-        image.save(output_path)
+        images = orjson.loads(response.content)['images']
+        if len(images) != len(prompts):
+            raise ValueError(f"Expected {len(prompts)} images, got {len(images)}")
+    except Exception as e:
+        print(f"Error generating image batch with StreamDiffusion: {str(e)}")
+        return None
+    
+    # Decode and save the images in parallel
+    saved_paths = list(_image_pool.map(save_image, images, output_paths))
+    
+    for prompt, saved_path in zip(prompts, saved_paths):
+        if saved_path:
+            store_cached_image(prompt, settings, saved_path)
+    return saved_paths
+
+# Signatures of the image formats the Stable Diffusion API can return
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+def save_image(encoded_image: str, output_path: str) -> Optional[str]:
+    """
+    Save a base64-encoded image returned by the Stable Diffusion API
+    
+    Args:
+        encoded_image: Base64-encoded image data
+        output_path: Path to save the image; the extension is changed to .jpg
+            if the API returned a JPEG
+        
+    Returns:
+        Path to the saved image or None if saving failed
+    """
+    try:
+        image_bytes = base64.b64decode(encoded_image)
+        
+        # The API returns PNG unless the webui is set to save JPEG; keep the extension honest
+        if image_bytes.startswith(JPEG_MAGIC):
+            output_path = os.path.splitext(output_path)[0] + ".jpg"
+        elif not image_bytes.startswith(PNG_MAGIC):
+            raise ValueError("Unsupported image format")
+        
+        # The bytes are already an encoded image, so write them as they are
+        # instead of decoding the pixels and re-encoding them
+        with open(output_path, "wb") as f:
+            f.write(image_bytes)
         
         print(f"Image saved to: {output_path}")
         return output_path
     except Exception as e:
-        print(f"Error generating image: {str(e)}")
+        print(f"Error saving image: {str(e)}")
         return None
 
+def download_image(payload: Dict[str, Any], output_path: str) -> str:
+    """
+    Generate an image through the raw image proxy and stream it straight to disk
+    
+    Args:
+        payload: txt2img payload to forward to the proxy
+        output_path: Path to save the image; the extension is changed to .jpg
+            if the proxy returns a JPEG
+        
+    Returns:
+        Path to the saved image
+    """
+    with _sd_session.post(url=f'{SD_IMAGE_PROXY_URL}/txt2img', data=orjson.dumps(payload), stream=True) as response:
+        response.raise_for_status()  # Raise exception for 4XX/5XX responses
+        
+        content_type = response.headers.get("Content-Type", "")
+        if content_type.startswith("image/jpeg"):
+            output_path = os.path.splitext(output_path)[0] + ".jpg"
+        elif not content_type.startswith("image/png"):
+            raise ValueError(f"Unsupported image type: {content_type}")
+        
+        # Write to a temporary file so a broken stream never leaves a partial panel
+        tmp_path = output_path + ".part"
+        response.raw.decode_content = True
+        try:
+            with open(tmp_path, "wb") as f:
+                shutil.copyfileobj(response.raw, f)
+            os.replace(tmp_path, output_path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    
+    print(f"Image saved to: {output_path}")
+    return output_path
+
 def print_comic_panels(panels: Dict[str, str]) -> None:
     """Pretty print the comic panels"""
     print("\n" + "="*50)
@@ -305,7 +967,7 @@ def api_generate_comic():
     API endpoint for generating comics from dream descriptions
     
     Expected request parameters:
-    - dream_text: String description of the dream
+    - dream_text: String description of the dream (at most MAX_DREAM_TEXT_LENGTH characters)
     - image: Optional image file to include with the dream
     - generate_images: Boolean indicating whether to generate images (default: False)
     - translate_to_chinese: Boolean indicating whether to translate to Chinese (default: False)
@@ -319,10 +981,24 @@ def api_generate_comic():
             print(f"New form request received: {request.form}")
             data = request.form.to_dict()
         
-        # Get dream text (required)
+        # Get dream text (required) and reject unusable input before any model call
         dream_text = data.get('dream_text') or data.get('prompt')
-        if not dream_text:
+        if not isinstance(dream_text, str) or not dream_text.strip():
             return jsonify({'error': 'Missing required parameter: dream_text'}), 400
+        dream_text = dream_text.strip()
+        if len(dream_text) > MAX_DREAM_TEXT_LENGTH:
+            return jsonify({'error': f'dream_text must be at most {MAX_DREAM_TEXT_LENGTH} characters'}), 400
+        
+        # Answer an exact repeat of an earlier dream with its comic while that session still exists.
+        # The stored response is replaced once its session expires, so it is read from the
+        # database rather than through the in-memory lookup
+        response_key = cache_key("comic", dream_text)
+        cached_response = read_cache(response_key) if 'image' not in request.files else None
+        if cached_response:
+            cached_response = json.loads(cached_response)
+            if os.path.isdir(os.path.join(app.config['OUTPUT_FOLDER'], cached_response['session_id'])):
+                print(f"Returning cached comic, session id: {cached_response['session_id']}")
+                return jsonify(cached_response)
             
         # Process image if provided
         image_path = None
@@ -337,7 +1013,8 @@ def api_generate_comic():
         # Create unique output directory for this request
         session_id = str(uuid.uuid4())
         output_dir = os.path.join(app.config['OUTPUT_FOLDER'], session_id)
-        os.makedirs(output_dir, exist_ok=True)
+        # OUTPUT_FOLDER is created at startup and the id is new, so one mkdir is enough
+        os.mkdir(output_dir)
 
         #Print uuid
         print(f"New request received, session id: {session_id}")
@@ -371,11 +1048,16 @@ def api_generate_comic():
                 
             # Add image info if available
             image_key = f"{panel_key}_image"
-            if image_key in comic_result and os.path.exists(comic_result[image_key]):
+            # Saved images are paths in output_dir; anything else is an error message
+            if image_key in comic_result and os.path.dirname(comic_result[image_key]) == output_dir:
                 image_filename = os.path.basename(comic_result[image_key])
                 panel_data['image_url'] = f"/api/images/{session_id}/{image_filename}"
                 
             response_data['panels'][panel_key] = panel_data
+        
+        # Remember complete comics so a repeat of the same dream can be answered directly
+        if 'image' not in request.files and all('image_url' in panel for panel in response_data['panels'].values()):
+            cache_store(response_key, json.dumps(response_data), replace=True)
             
         # Return the response
         return jsonify(response_data)
@@ -390,6 +1072,69 @@ def serve_image(session_id, filename):
     directory = os.path.join(app.config['OUTPUT_FOLDER'], session_id)
     return send_from_directory(directory, filename)
 
+# Endpoint to serve all panel images of a session in one request
+@app.route('/api/session/<session_id>/panels.zip')
+def serve_panels_bundle(session_id):
+    """Serve all generated panel images of a session as a single zip archive"""
+    directory = os.path.join(app.config['OUTPUT_FOLDER'], secure_filename(session_id))
+    # List the directory once instead of checking each possible panel file
+    try:
+        filenames = set(os.listdir(directory))
+    except (FileNotFoundError, NotADirectoryError):
+        return jsonify({'error': 'Session not found'}), 404
+    
+    buffer = io.BytesIO()
+    # The images are already compressed, so store them without recompressing
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as bundle:
+        for i in range(1, 5):
+            for filename in (f"panel_{i}.png", f"panel_{i}.jpg"):
+                if filename in filenames:
+                    bundle.write(os.path.join(directory, filename), filename)
+                    break
+    buffer.seek(0)
+    return send_file(buffer, mimetype='application/zip', download_name=f"{session_id}_panels.zip")
+
+def cleanup_old_sessions(max_age: float = SESSION_MAX_AGE) -> int:
+    """
+    Delete session output directories and uploads older than max_age seconds
+    
+    Args:
+        max_age: Age in seconds after which an entry is deleted
+        
+    Returns:
+        Number of entries deleted
+    """
+    cutoff = time.time() - max_age
+    removed = 0
+    for folder in (OUTPUT_FOLDER, UPLOAD_FOLDER):
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime >= cutoff:
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.remove(entry.path)
+                    removed += 1
+                except OSError as e:
+                    print(f"Error removing {entry.path}: {str(e)}")
+    return removed
+
+def _janitor() -> None:
+    """Periodically delete expired sessions and prune the cache so disk use stays bounded"""
+    while True:
+        removed = cleanup_old_sessions()
+        if removed:
+            print(f"Janitor removed {removed} expired sessions and uploads")
+        try:
+            pruned = prune_cache()
+            if pruned:
+                print(f"Janitor removed {pruned} cached images")
+        except (OSError, sqlite3.Error) as e:
+            print(f"Error pruning cache: {str(e)}")
+        time.sleep(JANITOR_INTERVAL)
+
 def main():
     """Main function to run the script from command line"""
     parser = argparse.ArgumentParser(description="Dream Comic Generator")
@@ -400,12 +1145,16 @@ def main():
     parser.add_argument("--translate", action="store_true", help="Translate panel descriptions to Traditional Chinese")
     parser.add_argument("--server", action="store_true", help="Run as a Flask API server")
     parser.add_argument("--port", type=int, default=5000, help="Port for the Flask API server")
+    parser.add_argument("--threads", type=int, default=8, help="Number of worker threads for the API server")
     
     args = parser.parse_args()
     
     if args.server:
-        # Run as a Flask API server
-        app.run(host='0.0.0.0', port=args.port, debug=False)
+        # Run the Flask app under waitress, a production WSGI server, so each comic
+        # generation gets its own worker thread while it waits on the AI backends
+        threading.Thread(target=_janitor, daemon=True).start()
+        print(f"Serving API on port {args.port} with {args.threads} threads")
+        serve(app, host='0.0.0.0', port=args.port, threads=args.threads)
     elif args.text:
         # Run in CLI mode with the provided arguments
         generate_dream_comic(
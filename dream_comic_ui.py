@@ -0,0 +1,446 @@
+"""
+Shared UI helpers for the Dream Comic Generator Streamlit client.
+
+Imported once per server process, so the helpers, HTTP session and storage
+paths are not rebuilt on every Streamlit rerun of the client script.
+"""
+import requests
+import html
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import io
+from PIL import Image
+import os
+import streamlit as st
+import orjson
+import datetime
+import hashlib
+from pathlib import Path
+import shutil
+import threading
+import uuid
+import zipfile
+import msgpack
+from concurrent.futures import ThreadPoolExecutor, as_completed, Future
+
+# Variables
+url = "https://api.jimmyn.idv.tw"
+
+# Storage locations, resolved once instead of on every call and rerun
+BASE_DIR = Path(__file__).resolve().parent
+COMICS_DIR = BASE_DIR / "dream_comics"
+PANELS_DIR = BASE_DIR / "static" / "dream_comics"
+HISTORY_FILE = COMICS_DIR / "history.msgpack"
+TRASH_DIR = COMICS_DIR / ".trash"
+COMICS_DIR.mkdir(exist_ok=True)
+PANELS_DIR.mkdir(parents=True, exist_ok=True)
+TRASH_DIR.mkdir(exist_ok=True)
+
+# Panels are shown at most a column wide, so only a downscaled WebP copy is kept on disk
+PANEL_MAX_SIZE = (768, 768)
+# Set to True to also keep the full-resolution PNG sent by the server
+KEEP_ORIGINAL_PANELS = False
+
+# Shared HTTP session so the generate request and the panel downloads reuse connections
+SESSION = requests.Session()
+# Retry transient gateway errors on idempotent requests (the generate POST is not retried)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+))
+# (connect, read) timeout for image downloads, which run on the Streamlit script thread
+DOWNLOAD_TIMEOUT = (5, 60)
+
+# Function to open a connection to the API server ahead of the first real request
+def _prewarm_connection():
+    try:
+        SESSION.head(url, timeout=5)
+    except requests.exceptions.RequestException:
+        # Only a warm-up; the real request will connect on its own
+        pass
+
+# Do the TCP and TLS handshake at startup so the pooled socket is ready for the first generate
+threading.Thread(target=_prewarm_connection, daemon=True).start()
+
+# Function to run a long request on its own daemon thread and return a future for it;
+# every request gets its own thread so one user's generation never queues behind another's
+def run_in_background(fn, *args, **kwargs):
+    future = Future()
+    
+    def _run():
+        # Skip the call if the future was cancelled before the thread got to it
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+    
+    threading.Thread(target=_run, daemon=True).start()
+    return future
+
+# Custom CSS for fixed-height description containers and panel images
+FIXED_HEIGHT_CSS = """
+<style>
+    .fixed-height-container {
+        height: 150px;
+        overflow-y: auto;
+        margin-bottom: 10px;
+        background-color: rgba(240, 240, 240, 0.3);
+        padding: 8px;
+        border-radius: 4px;
+    }
+    .panel-image {
+        width: 100%;
+    }
+    .panel-caption {
+        text-align: center;
+        color: rgba(49, 51, 63, 0.6);
+        font-size: 14px;
+        margin-bottom: 10px;
+    }
+</style>
+"""
+
+# Function to build the description and translation of a panel as one HTML blob
+def panel_texts(en, zh):
+    # Escape the LLM output so stray markup in a description cannot break the page
+    return (
+        '<p><strong>Description:</strong></p>'
+        f'<div class="fixed-height-container">{html.escape(en)}</div>'
+        '<p><strong>Chinese Description:</strong></p>'
+        f'<div class="fixed-height-container">{html.escape(zh)}</div>'
+    )
+
+# Function to move panel images saved before static serving into the static folder
+def _migrate_panels_to_static():
+    # Panel images live under static/ so Streamlit serves them directly; the history
+    # ledger stays in dream_comics/ so it is not exposed over HTTP
+    with os.scandir(COMICS_DIR) as entries:
+        for entry in entries:
+            if entry.name == TRASH_DIR.name or not entry.is_dir(follow_symlinks=False):
+                continue
+            target = PANELS_DIR / entry.name
+            if not target.exists():
+                shutil.move(entry.path, str(target))
+
+_migrate_panels_to_static()
+
+# Function to delete a directory without blocking the Streamlit script thread
+def _remove_in_background(path):
+    # Renaming is instant, so callers can update the UI right away while the
+    # recursive delete runs on a daemon thread
+    trash_path = TRASH_DIR / uuid.uuid4().hex
+    os.replace(path, trash_path)
+    threading.Thread(target=shutil.rmtree, args=(trash_path, True), daemon=True).start()
+
+# Clear out anything left in the trash by a previous process
+for _leftover in TRASH_DIR.iterdir():
+    threading.Thread(target=shutil.rmtree, args=(_leftover, True), daemon=True).start()
+
+# Function to append a record to the append-only history ledger
+def _append_history(record):
+    with open(HISTORY_FILE, 'ab') as f:
+        f.write(msgpack.packb(record))
+
+# Function to rewrite the history ledger with only the given records
+def _write_history(records):
+    tmp_file = HISTORY_FILE.with_suffix('.msgpack.tmp')
+    with open(tmp_file, 'wb') as f:
+        for record in records:
+            f.write(msgpack.packb(record))
+    os.replace(tmp_file, HISTORY_FILE)
+
+# Function to apply one ledger record to the history index
+def _apply_history_record(index, record):
+    # Skip anything that is not a history entry or tombstone; compaction drops it
+    if not isinstance(record, dict) or not ('deleted' in record or 'session_id' in record):
+        return True
+    if 'deleted' in record:
+        index.pop(record['deleted'], None)
+        return True
+    index[record['session_id']] = record
+    return False
+
+# Function to build the history index, read from the ledger once per server process
+@st.cache_resource
+def _history_index():
+    index = {}
+    needs_compaction = False
+    if HISTORY_FILE.exists():
+        with open(HISTORY_FILE, 'rb') as f:
+            unpacker = msgpack.Unpacker(f, raw=False)
+            try:
+                for record in unpacker:
+                    needs_compaction |= _apply_history_record(index, record)
+            except (ValueError, msgpack.UnpackException):
+                # Drop a corrupt record on the compaction below
+                needs_compaction = True
+            # Iteration stops quietly at a partially written trailing record; compact now
+            # so the next append doesn't land after it
+            if unpacker.tell() != os.fstat(f.fileno()).st_size:
+                needs_compaction = True
+    
+    # Pick up per-session metadata.json files saved before the ledger existed
+    legacy_files = []
+    # os.scandir reports the entry type from the directory listing, and opening the file
+    # directly avoids a separate exists() stat per session
+    with os.scandir(PANELS_DIR) as entries:
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            metadata_file = Path(entry.path) / "metadata.json"
+            try:
+                with open(metadata_file, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            legacy_files.append(metadata_file)
+            try:
+                metadata = orjson.loads(data)
+                index.setdefault(metadata.get('session_id', entry.name), metadata)
+            except:
+                # Skip if metadata can't be loaded
+                pass
+    
+    # Compact lazily: drop tombstones and fold legacy JSON files into the ledger
+    if needs_compaction or legacy_files:
+        _write_history(index.values())
+        for legacy_file in legacy_files:
+            legacy_file.unlink(missing_ok=True)
+    return index
+
+# Function to save generation metadata
+def save_generation_metadata(session_id, prompt, response_data):
+    # Skip the write if this exact generation is already in the history
+    content_hash = hashlib.blake2b((session_id + prompt).encode(), digest_size=16).hexdigest()
+    index = _history_index()
+    if index.get(session_id, {}).get('hash') == content_hash:
+        return
+    
+    # Create metadata with timestamp and prompt
+    metadata = {
+        'session_id': session_id,
+        'timestamp': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'prompt': prompt,
+        'hash': content_hash,
+        'response_data': response_data
+    }
+    
+    # Append metadata to the history ledger
+    _append_history(metadata)
+    
+    # Keep the in-memory history index in sync
+    index[session_id] = metadata
+
+# Function to delete a specific session
+def delete_session(session_id):
+    try:
+        session_dir = PANELS_DIR / session_id
+        index = _history_index()
+        if session_id in index or session_dir.exists():
+            # Tombstone the entry first; it is compacted out the next time the ledger is loaded
+            _append_history({'deleted': session_id})
+            index.pop(session_id, None)
+            if session_dir.exists():
+                _remove_in_background(session_dir)
+            # Reset selected session if it was deleted
+            if (st.session_state.selected_session and 
+                st.session_state.selected_session.get('session_id') == session_id):
+                st.session_state.selected_session = None
+                st.session_state.view_mode = 'new'
+            return True
+        return False
+    except Exception as e:
+        st.error(f"Error deleting session: {e}")
+        return False
+
+# Function to delete all history
+def delete_all_history():
+    try:
+        if PANELS_DIR.exists():
+            _write_history([])
+            _history_index().clear()
+            # Move the whole panel folder aside and recreate it for new comics
+            _remove_in_background(PANELS_DIR)
+            PANELS_DIR.mkdir(parents=True, exist_ok=True)
+            st.session_state.selected_session = None
+            st.session_state.view_mode = 'new'
+            return True
+        return False
+    except Exception as e:
+        st.error(f"Error deleting all history: {e}")
+        return False
+
+# Function to get list of previous generations
+def get_previous_generations():
+    # Sort by timestamp, newest first
+    return sorted(_history_index().values(), key=lambda x: x.get('timestamp', ''), reverse=True)
+
+# Function to render the four panels of a comic in a 2x2 grid
+def render_panels(response_data, session_id):
+    row1_col1, row1_col2 = st.columns(2)
+    row2_col1, row2_col2 = st.columns(2)
+    
+    for col, i in [(row1_col1, 1), (row1_col2, 2), (row2_col1, 3), (row2_col2, 4)]:
+        with col:
+            panel = response_data['panels'][f'panel{i}']
+            st.subheader(f"Panel {i}")
+            # One st.html call per panel instead of four markdown messages
+            st.html(panel_texts(panel['description'], panel['chinese']))
+            display_image_from_url(panel['image_url'], i, session_id)
+
+# Function to display a comic from stored metadata
+def display_comic_from_metadata(metadata):
+    st.subheader("DREAM COMIC")
+    st.write(f"Session ID: {metadata['session_id']}")
+    st.write(f"Generated on: {metadata['timestamp']}")
+    st.write(f"Prompt: {metadata['prompt']}")
+    st.markdown("---")
+    
+    # Get response data from metadata
+    response_data = metadata['response_data']
+    session_id = metadata['session_id']
+    
+    # Offer to fetch every missing panel at once, concurrently and before the grid is
+    # drawn, so no network I/O happens inside the panel columns
+    missing = [i for i in range(1, 5) if _local_panel_path(session_id, i) is None]
+    if missing and st.button("Load all images 載入所有圖片", key=f"load_all_{session_id}"):
+        with st.spinner("Downloading panel images..."):
+            fetch_panel_images(response_data, session_id)
+    
+    render_panels(response_data, session_id)
+
+# Function to find the saved image of a panel, preferring the downscaled WebP copy
+def _local_panel_path(session_id, panel_num):
+    for suffix in ('.webp', '.png', '.jpg'):
+        local_path = PANELS_DIR / session_id / f"panel_{panel_num}{suffix}"
+        if local_path.exists():
+            return local_path
+    return None
+
+# Function to replace a downloaded panel PNG or JPEG with a downscaled WebP copy
+def _compact_panel(png_path):
+    webp_path = png_path.with_suffix('.webp')
+    tmp_path = png_path.with_suffix('.webp.part')
+    try:
+        with Image.open(png_path) as image:
+            image.thumbnail(PANEL_MAX_SIZE)
+            image.save(tmp_path, 'WEBP', quality=85)
+        os.replace(tmp_path, webp_path)
+    except OSError as e:
+        # Keep the PNG if it cannot be converted
+        print(f"Error compacting {png_path}: {e}")
+        tmp_path.unlink(missing_ok=True)
+        return
+    if not KEEP_ORIGINAL_PANELS:
+        png_path.unlink(missing_ok=True)
+
+# Function to pick the local file name for a panel, keeping the server's image format
+def _panel_download_path(save_dir, panel_num, image_url):
+    suffix = '.jpg' if image_url.endswith('.jpg') else '.png'
+    return save_dir / f"panel_{panel_num}{suffix}"
+
+# Function to stream a panel image from the server straight to disk
+def _download_panel(image_url, local_path):
+    # Write to a temporary file first so a failed download never looks like a saved panel
+    tmp_path = local_path.with_suffix('.part')
+    try:
+        with SESSION.get(f"{url}{image_url}", stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            with open(tmp_path, 'wb') as fh:
+                shutil.copyfileobj(response.raw, fh)
+        os.replace(tmp_path, local_path)
+        _compact_panel(local_path)
+        return True
+    except (requests.exceptions.RequestException, OSError) as e:
+        print(f"Error fetching {image_url}: {e}")
+        tmp_path.unlink(missing_ok=True)
+        return False
+
+# Function to render a saved panel image through Streamlit's static file server
+def _render_panel(session_id, panel_num):
+    local_path = _local_panel_path(session_id, panel_num)
+    if local_path is None:
+        st.error(f"Failed to fetch image {panel_num}.")
+        return False
+    # The browser loads the image straight from /app/static, so nothing is decoded or
+    # re-sent over the websocket on reruns, and lazy loading skips off-screen panels
+    st.markdown(
+        f'<img class="panel-image" loading="lazy" src="app/static/dream_comics/{session_id}/{local_path.name}">'
+        f'<div class="panel-caption">Panel {panel_num}</div>',
+        unsafe_allow_html=True
+    )
+    return True
+
+# Function to download all four panel images in one zip bundle and save them locally
+def get_panels_bundle(session_id):
+    save_dir = PANELS_DIR / session_id
+    save_dir.mkdir(parents=True, exist_ok=True)
+    
+    try:
+        response = SESSION.get(f"{url}/api/session/{session_id}/panels.zip", timeout=DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+        with zipfile.ZipFile(io.BytesIO(response.content)) as bundle:
+            names = set(bundle.namelist())
+            # Only extract the expected panel names so nothing can escape save_dir
+            for i in range(1, 5):
+                for name in (f"panel_{i}.png", f"panel_{i}.jpg"):
+                    if name in names:
+                        (save_dir / name).write_bytes(bundle.read(name))
+                        _compact_panel(save_dir / name)
+                        break
+        return True
+    except (requests.exceptions.RequestException, zipfile.BadZipFile, OSError) as e:
+        print(f"Error fetching panel bundle for {session_id}: {e}")
+        return False
+
+# Function to download all four panel images and save them locally
+def fetch_panel_images(response_data, session_id):
+    save_dir = PANELS_DIR / session_id
+    
+    # Fetch every panel in a single request, then fall back to per-panel downloads
+    # for anything the bundle did not include (e.g. an older server)
+    get_panels_bundle(session_id)
+    panel_images = {}
+    missing = []
+    for i in range(1, 5):
+        local_path = _local_panel_path(session_id, i)
+        if local_path is not None:
+            panel_images[i] = local_path
+        else:
+            missing.append(i)
+    if not missing:
+        return panel_images
+    
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = {
+            executor.submit(
+                _download_panel,
+                response_data['panels'][f'panel{i}']['image_url'],
+                _panel_download_path(save_dir, i, response_data['panels'][f'panel{i}']['image_url'])
+            ): i
+            for i in missing
+        }
+        for future in as_completed(futures):
+            panel_num = futures[future]
+            panel_images[panel_num] = _local_panel_path(session_id, panel_num) if future.result() else None
+    return panel_images
+
+# Function to display image from URL or local file
+def display_image_from_url(image_url, panel_num, session_id):
+    # Check if image exists locally first
+    save_dir = PANELS_DIR / session_id
+    
+    # If not local, only stream the image from URL to disk once the user asks for it
+    if _local_panel_path(session_id, panel_num) is None:
+        if not st.button(f"Load panel {panel_num} image", key=f"load_{session_id}_{panel_num}"):
+            st.caption("Image not downloaded yet.")
+            return False
+        save_dir.mkdir(parents=True, exist_ok=True)
+        with st.spinner(f"Downloading panel {panel_num}..."):
+            _download_panel(image_url, _panel_download_path(save_dir, panel_num, image_url))
+    
+    return _render_panel(session_id, panel_num)